@@ -1,9 +1,14 @@
+import concurrent.futures
+import functools
+import math
+import os
 import time
 
 import h5py
 import hdf5plugin
 import matplotlib.pyplot as plt
 import meshio
+import numba
 import numpy as np
 import scipy.ndimage
 from matplotlib.colors import hsv_to_rgb
@@ -11,36 +16,210 @@ from matplotlib.colors import hsv_to_rgb
 import darling
 
 
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _wrap2pi_kernel(x, out):
+    """Elementwise wrap of angles, in radians, to the interval [0, 2*pi).
+
+    Args:
+        x (:obj:`numpy array`): angle map of shape=(a, b).
+        out (:obj:`numpy array`): output buffer of shape=(a, b), may alias x.
+    """
+    two_pi = 2 * np.pi
+    for i in numba.prange(x.shape[0]):
+        for j in range(x.shape[1]):
+            out[i, j] = x[i, j] % two_pi
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _mosa_kernel(ang1, ang2, angles_out, radius_out):
+    """Fused per-pixel mosaicity mapping.
+
+    Computes the normalized polar angle (wrapped to [0, 2*pi) and scaled to [0, 1])
+    and the polar radius of each (ang1, ang2) pair in a single pass, followed by a
+    second pass normalizing the radius by its maximum.
+
+    Args:
+        ang1 (:obj:`numpy array`): first angular coordinate map, shape=(a, b).
+        ang2 (:obj:`numpy array`): second angular coordinate map, shape=(a, b).
+        angles_out (:obj:`numpy array`): output buffer for normalized angles, shape=(a, b).
+        radius_out (:obj:`numpy array`): output buffer for normalized radii, shape=(a, b).
+    """
+    two_pi = 2 * np.pi
+    radius_max = 0.0
+    for i in numba.prange(ang1.shape[0]):
+        for j in range(ang1.shape[1]):
+            a = math.atan2(-ang1[i, j], -ang2[i, j])
+            angles_out[i, j] = (a % two_pi) / two_pi
+            r = math.sqrt(ang1[i, j] * ang1[i, j] + ang2[i, j] * ang2[i, j])
+            radius_out[i, j] = r
+            radius_max = max(radius_max, r)
+    if radius_max > 0:
+        for i in numba.prange(radius_out.shape[0]):
+            for j in range(radius_out.shape[1]):
+                radius_out[i, j] /= radius_max
+
+
+@numba.guvectorize(
+    [(numba.uint16[:, :], numba.uint16, numba.uint16[:, :])],
+    "(m,n),()->(m,n)",
+    nopython=True,
+    target="parallel",
+)
+def _subtract_clamped(frame, value, res):
+    """Saturating uint16 subtraction, clamping at zero instead of wrapping.
+
+    Args:
+        frame (:obj:`numpy array`): a 2d uint16 map to proccess.
+        value (:obj:`int`): value to subtract.
+        res (:obj:`numpy array`): array in which to store output, may alias frame.
+    """
+    for i in range(frame.shape[0]):
+        for j in range(frame.shape[1]):
+            v = frame[i, j]
+            res[i, j] = v - value if v > value else 0
+
+
+@numba.njit(parallel=True, cache=True)
+def _subtract_clamped_flat(flat, value):
+    """Saturating in-place uint16 subtraction over a flat contiguous view.
+
+    The single branchless loop lets LLVM emit packed saturating-subtract SIMD
+    instructions; used when the data stack is C-contiguous.
+
+    Args:
+        flat (:obj:`numpy array`): flattened uint16 data to proccess in place.
+        value (:obj:`int`): value to subtract.
+    """
+    for i in numba.prange(flat.size):
+        v = flat[i]
+        flat[i] = v - value if v > value else 0
+
+
+# no fastmath here: the kernel must see NaNs from masked pixels.
+@numba.njit(parallel=True, cache=True)
+def _hsv_to_rgb_kernel(hue, saturation, rgb_out):
+    """Fused HSV to RGB conversion with the value channel fixed at 1.
+
+    Equivalent to stacking (hue, saturation, ones) and calling
+    matplotlib.colors.hsv_to_rgb, but reads the two input maps directly and
+    writes into a preallocated buffer. NaN entries (masked pixels) map to
+    hue = saturation = 0 as the previous nan-to-zero fixup did.
+
+    Args:
+        hue (:obj:`numpy array`): hue map in [0, 1], shape=(a, b).
+        saturation (:obj:`numpy array`): saturation map in [0, 1], shape=(a, b).
+        rgb_out (:obj:`numpy array`): output buffer of shape=(a, b, 3).
+    """
+    for i in numba.prange(hue.shape[0]):
+        for j in range(hue.shape[1]):
+            h = hue[i, j]
+            s = saturation[i, j]
+            if math.isnan(h) or math.isnan(s):
+                h = 0.0
+                s = 0.0
+            h6 = h * 6.0
+            k = int(h6) % 6
+            f = h6 - math.floor(h6)
+            p = 1.0 - s
+            q = 1.0 - s * f
+            t = 1.0 - s * (1.0 - f)
+            if k == 0:
+                r, g, b = 1.0, t, p
+            elif k == 1:
+                r, g, b = q, 1.0, p
+            elif k == 2:
+                r, g, b = p, 1.0, t
+            elif k == 3:
+                r, g, b = p, q, 1.0
+            elif k == 4:
+                r, g, b = t, p, 1.0
+            else:
+                r, g, b = 1.0, p, q
+            rgb_out[i, j, 0] = r
+            rgb_out[i, j, 1] = g
+            rgb_out[i, j, 2] = b
+
+
+@numba.guvectorize(
+    [(numba.uint16[:, :], numba.float32[:], numba.float32[:])],
+    "(m,n),(p)->(p)",
+    nopython=True,
+    target="parallel",
+)
+def _integrate_frames(frames, dum, res):
+    """Sum the (m, n) motor distribution of a single pixel into a float32 count.
+
+    Args:
+        frames (:obj:`numpy array`): a 2d uint16 map to reduce.
+        dum (:obj:`numpy array`): dummpy variable for numba shapes. (len=1)
+        res (:obj:`numpy array`): array in which to store output.
+    """
+    s = 0.0
+    for k in range(frames.shape[0]):
+        for l in range(frames.shape[1]):
+            s += frames[k, l]
+    res[0] = s
+
+
+@functools.lru_cache(maxsize=1)
+def _hsv_colormap_grid(resolution=400):
+    """Build the HSV colormap key used in mosaicity plots.
+
+    The grid depends on nothing instance-specific, so it is computed once and
+    cached for the lifetime of the process.
+    """
+    ang_grid = np.linspace(-1, 1, resolution)
+    ang1, ang2 = np.meshgrid(ang_grid, ang_grid)
+    angles = np.empty_like(ang1)
+    radius = np.empty_like(ang1)
+    _mosa_kernel(ang1, ang2, angles, radius)
+    hsv_key = np.stack((angles, radius, np.ones(angles.shape)), axis=2)
+    colormap = hsv_to_rgb(hsv_key)
+    # the same array instance is handed out to every caller; freeze it so a
+    # consumer cannot silently corrupt the cache.
+    colormap.setflags(write=False)
+    return colormap
+
+
+# mapping from substrings of motor names to pretty plot labels; the first
+# matching entry wins, so new motor types are added as a single line.
+_LABEL_MAP = (
+    ("chi", r"$\chi$"),
+    ("phi", r"$\phi$"),
+    ("ccmth", r"ccmth"),
+    ("strain", r"$\varepsilon$"),
+    ("energy", r"energy"),
+    ("diffrz", r"diffrz"),
+    ("diffry", r"diffry"),
+)
+
+
 class _Visualizer(object):
 
     # TODO: some of this should probably be in the properties module...
 
     def __init__(self, dset_reference):
         self.dset = dset_reference
-        self.labels = self.dset.reader.motor_names[:]
-        for i, label in enumerate(self.labels):
-            if "chi" in self.labels[i]:
-                self.labels[i] = r"$\chi$"
-            if "phi" in self.labels[i]:
-                self.labels[i] = r"$\phi$"
-            if "ccmth" in self.labels[i]:
-                self.labels[i] = r"ccmth"
-            if "strain" in self.labels[i]:
-                self.labels[i] = r"$\varepsilon$"
-            if "energy" in self.labels[i]:
-                self.labels[i] = r"energy"
-            if "diffrz" in self.labels[i]:
-                self.labels[i] = r"diffrz"
-            if "diffry" in self.labels[i]:
-                self.labels[i] = r"diffry"
+        self.labels = [
+            next((label for key, label in _LABEL_MAP if key in name), name)
+            for name in self.dset.reader.motor_names
+        ]
         self.motor_xlabel = self.labels[0]
         self.motor_ylabel = self.labels[1]
 
         self.xlabel = "Detector row index"
         self.ylabel = "Detector column index"
 
+        self._style_applied = False
+
+    def _apply_style(self):
+        # plt.style.use re-parses the style rcParams; only pay for that once.
+        if not self._style_applied:
+            plt.style.use("dark_background")
+            self._style_applied = True
+
     def mean(self):
-        plt.style.use("dark_background")
+        self._apply_style()
         fig, ax = plt.subplots(1, 2, figsize=(9, 6), sharex=True, sharey=True)
         fig.suptitle("Mean Map \nfirst moment around motor coordinates", fontsize=22)
         im_ratio = self.dset.mean.shape[0] / self.dset.mean.shape[1]
@@ -62,7 +241,7 @@ class _Visualizer(object):
             mask (:obj:`numpy array`): A binary mask with the same shape as the data set. If provided, the
                 covariance matrix will be plotted where the mask = 1. Defaults to None.
         """
-        plt.style.use("dark_background")
+        self._apply_style()
         fig, ax = plt.subplots(2, 2, figsize=(18, 18), sharex=True, sharey=True)
         fig.suptitle(
             "Covariance Map \nsecond moment around motor coordinates", fontsize=22
@@ -90,16 +269,22 @@ class _Visualizer(object):
         plt.show()
 
     def misorientation(self):
-        plt.style.use("dark_background")
+        self._apply_style()
         fig, ax = plt.subplots(1, 1, figsize=(9, 9), sharex=True, sharey=True)
         fig.suptitle(
             "Misorientation Map \nL2 norm of mean map after median subtraction",
             fontsize=22,
         )
-        mean = self.dset.mean.copy()
-        mean[:, :, 0] -= np.median(mean[:, :, 0].flatten())
-        mean[:, :, 1] -= np.median(mean[:, :, 1].flatten())
-        misori = np.linalg.norm(mean, axis=-1)
+        mean = self.dset.mean[:, :, :2]
+        medians = np.array(
+            [np.median(mean[:, :, 0]), np.median(mean[:, :, 1])],
+            dtype=mean.dtype,
+        )
+        # a single contracted einsum over the trailing axis avoids the square
+        # and sum temporaries of a norm over per-component difference maps.
+        deviation = mean - medians
+        misori = np.einsum("ijk,ijk->ij", deviation, deviation, optimize=True)
+        np.sqrt(misori, out=misori)
         im_ratio = misori.shape[0] / misori.shape[1]
         im = ax.imshow(misori, cmap="viridis")
         fig.colorbar(im, ax=ax, fraction=0.046 * im_ratio, pad=0.04)
@@ -112,39 +297,30 @@ class _Visualizer(object):
     def _wrap2pi(self, x):
         """
         Python implementation of Matlab method `wrapTo2pi`.
-        Wraps angles in x, in radians, to the interval [0, 2*pi] such that 0 maps
-        to 0 and 2*pi maps to 2*pi. In general, positive multiples of 2*pi map to
-        2*pi and negative multiples of 2*pi map to 0.
+        Wraps angles in x, in radians, to the interval [0, 2*pi). Since the wrapped
+        angles are used as HSV hues, the 2*pi boundary (hue 1, identical to hue 0)
+        folds to 0, which allows a single branchless pass over the array without
+        temporary masks.
         """
-        xwrap = np.remainder(x - np.pi, 2 * np.pi)
-        mask = np.abs(xwrap) > np.pi
-        xwrap[mask] -= 2 * np.pi * np.sign(xwrap[mask])
-        return xwrap + np.pi
+        out = np.empty_like(x)
+        _wrap2pi_kernel(x, out)
+        return out
 
     def _hsv_key(self, angles, radius):
-        return np.stack(
-            (
-                angles,  # HUE (the actual color)
-                radius,  # SATURATION (how saturated the color is)
-                np.ones(angles.shape),  # VALUE. (white to black)
-            ),
-            axis=2,
-        )
+        hsv_key = np.empty(angles.shape + (3,), dtype=angles.dtype)
+        hsv_key[..., 0] = angles  # HUE (the actual color)
+        hsv_key[..., 1] = radius  # SATURATION (how saturated the color is)
+        hsv_key[..., 2] = 1.0  # VALUE. (white to black)
+        return hsv_key
 
     def _mosa(self, ang1, ang2):
-        angles = np.arctan2(-ang1, -ang2)
-        anlges_normalized = self._wrap2pi(angles) / np.pi / 2
-        radius = np.sqrt(ang1**2 + ang2**2)
-        radius_normalized = radius / radius.max()
-        return anlges_normalized, radius_normalized
+        angles_normalized = np.empty_like(ang1)
+        radius_normalized = np.empty_like(ang1)
+        _mosa_kernel(ang1, ang2, angles_normalized, radius_normalized)
+        return angles_normalized, radius_normalized
 
     def _hsv_colormap(self):
-        ang_grid = np.linspace(-1, 1, 400)
-        ang1, ang2 = np.meshgrid(ang_grid, ang_grid)
-        angles, radius = self._mosa(ang1, ang2)
-        hsv_key = self._hsv_key(angles, radius)
-        colormap = hsv_to_rgb(hsv_key)
-        return colormap
+        return _hsv_colormap_grid()
 
     def mosaicity(self, use_motors=False, mask=None):
         """
@@ -157,7 +333,9 @@ class _Visualizer(object):
             mask (:obj:`numpy array`): A 2D binary mask with the same shape as the data set. If provided, it scales the mosaicity map
                 where the mask == 1. Defaults to None.
         """
-        mean = self.dset.mean.copy()
+        # no defensive copy: the normalizations below write into fresh per-channel
+        # buffers, never into the stored mean map.
+        mean = self.dset.mean
         if use_motors:
             motor1_min, motor1_max = (
                 self.dset.motors[0].min(),
@@ -168,21 +346,21 @@ class _Visualizer(object):
                 self.dset.motors[1].max(),
             )
 
-            mean[:, :, 0] = np.clip(mean[:, :, 0], motor1_min, motor1_max)
-            mean[:, :, 1] = np.clip(mean[:, :, 1], motor2_min, motor2_max)
-
-            chi_norm = (mean[:, :, 0] - motor1_min) / (motor1_max - motor1_min)
-            phi_norm = (mean[:, :, 1] - motor2_min) / (motor2_max - motor2_min)
+            # normalize and clamp in-place; clipping the normalized values to [0, 1]
+            # is equivalent to clipping the means to the motor bounds first.
+            chi_norm = np.subtract(mean[:, :, 0], motor1_min)
+            chi_norm /= motor1_max - motor1_min
+            np.clip(chi_norm, 0, 1, out=chi_norm)
+            phi_norm = np.subtract(mean[:, :, 1], motor2_min)
+            phi_norm /= motor2_max - motor2_min
+            np.clip(phi_norm, 0, 1, out=phi_norm)
 
             if mask is not None:
                 chi_norm = np.where(mask, chi_norm, np.nan)
                 phi_norm = np.where(mask, phi_norm, np.nan)
 
-            mosa = np.stack((chi_norm, phi_norm, np.ones_like(chi_norm)), axis=-1)
-            mosa[np.isnan(mosa)] = 0
-            mosa[mosa > 1] = 1
-            mosa[mosa < 0] = 0
-            mosa = hsv_to_rgb(mosa)
+            mosa = np.empty(chi_norm.shape + (3,), dtype=np.float32)
+            _hsv_to_rgb_kernel(chi_norm, phi_norm, mosa)
             colormap = self._hsv_colormap()
 
             alpha_channel = np.where(np.isnan(chi_norm), 0, 1)
@@ -208,12 +386,16 @@ class _Visualizer(object):
                 ranges[0, 1] - ranges[0, 0],
                 ranges[1, 1] - ranges[1, 0],
             ]
-            chi_norm = (mean[:, :, 0] - mean[:, :, 0].min()) / ranges_magnitude[0] - 0.5
-            phi_norm = (mean[:, :, 1] - mean[:, :, 1].min()) / ranges_magnitude[1] - 0.5
+            chi_norm = np.subtract(mean[:, :, 0], ranges[0, 0])
+            chi_norm /= ranges_magnitude[0]
+            chi_norm -= 0.5
+            phi_norm = np.subtract(mean[:, :, 1], ranges[1, 0])
+            phi_norm /= ranges_magnitude[1]
+            phi_norm -= 0.5
             angles, radius = self._mosa(chi_norm, phi_norm)
-            hsv_key = self._hsv_key(angles, radius)
 
-            mosa = hsv_to_rgb(hsv_key)
+            mosa = np.empty(angles.shape + (3,), dtype=np.float32)
+            _hsv_to_rgb_kernel(angles, radius, mosa)
             colormap = self._hsv_colormap()
 
             if mask is not None:
@@ -233,7 +415,7 @@ class _Visualizer(object):
             phi_label = np.round(phi_label, decimals=3)
             phi_label = np.array([f"{phi:.3f}" for phi in phi_label])
 
-        plt.style.use("dark_background")
+        self._apply_style()
         fig, axs = plt.subplots(
             1, 2, figsize=(12, 9), gridspec_kw={"width_ratios": [3, 1]}
         )
@@ -278,10 +460,18 @@ class DataSet(object):
 
     def __init__(self, reader):
         self.reader = reader
-        self.plot = _Visualizer(self)
+        self._plot = None
         self.mean, self.covariance = None, None
         self.mean_3d, self.covariance_3d = None, None
 
+    @property
+    def plot(self):
+        # constructed lazily so load-only workloads never pay for the
+        # visualizer label setup.
+        if self._plot is None:
+            self._plot = _Visualizer(self)
+        return self._plot
+
     def load_scan(self, args, scan_id, roi=None):
         """Load a scan into RM.
 
@@ -299,11 +489,18 @@ class DataSet(object):
                 defaults to None, in which case all data is loaded. The roi refers to the detector
                 dimensions.
 
+        """
+        self.data, self.motors = self._read_scan(args, scan_id, roi)
+
+    def _read_scan(self, args, scan_id, roi=None):
+        """Read a scan through the reader and return (data, motors) without mutating state.
+
+        Handles the tuple/non-tuple args convention of load_scan().
         """
         if isinstance(args, tuple):
-            self.data, self.motors = self.reader(*args, scan_id, roi)
+            return self.reader(*args, scan_id, roi)
         else:
-            self.data, self.motors = self.reader(args, scan_id, roi)
+            return self.reader(args, scan_id, roi)
 
     def subtract(self, value):
         """Subtract a fixed integer value form the data. Protects against uint16 sign flips.
@@ -312,39 +509,62 @@ class DataSet(object):
             value (:obj:`int`): value to subtract.
 
         """
-        self.data.clip(value, None, out=self.data)
-        self.data -= value
+        if self.data.flags.c_contiguous:
+            _subtract_clamped_flat(self.data.reshape(-1), np.uint16(value))
+        else:
+            _subtract_clamped(self.data, np.uint16(value), self.data)
 
     def estimate_background(self):
         """Automatic background correction based on image statistics.
 
-        a set of sample data is extracted from the data block. The median and standard deviations are iteratively
-        fitted, rejecting outliers (which here is diffraction signal). Once the noise distirbution has been established
-        the value corresponding to the 99.99% percentile is returned. I.e the far tail of the noise is returned.
+        a set of sample data is extracted from the data block. The noise distribution is
+        established from the sample median and the median absolute deviation (MAD), which
+        is robust against outliers (which here is diffraction signal), so no iterative
+        refitting is needed. The value corresponding to the 99.99% percentile of the noise
+        is returned. I.e the far tail of the noise is returned.
 
         """
         sample_size = 40000
-        index = np.random.permutation(sample_size)
+        rng = np.random.default_rng()
+        index = rng.integers(0, self.data.size, sample_size)
         sample = self.data.flat[index]
-        sample = np.sort(sample)
-        noise = sample.copy()
-        for i in range(20):
-            mu = np.median(noise)
-            std = np.std(noise)
-            noise = noise[np.abs(noise) < mu + 2 * 3.891 * std]  # 99.99% confidence
+        mu = np.median(sample)
+        # 1.4826 * MAD estimates the standard deviation of the underlying noise.
+        std = 1.4826 * np.median(np.abs(sample - mu))
+        noise = sample[sample <= mu + 2 * 3.891 * std]  # 99.99% confidence
         background = np.max(noise)
         return background
 
-    def moments(self):
+    def moments(self, block_size=None):
         """Compute first and second moments.
 
         The internal attributes self.mean and self.covariance are set when this function is run.
 
+        Args:
+            block_size (:obj:`int`): Number of detector rows to process at a time. When set, the
+                moment maps are computed tile by tile into preallocated outputs, so that each tile
+                of the data stack and its accumulators stay resident in cache. Useful for scans
+                much larger than the CPU cache. Defaults to None, in which case the full data
+                stack is processed in a single pass.
+
         Returns:
             (:obj:`tupe` of :obj:`numpy array`): mean and covariance maps of shapes (a,b,2) and (a,b,2,2)
                 respectively with a=self.data.shape[0] and b=self.data.shape[1].
         """
-        self.mean, self.covariance = darling.properties.moments(self.data, self.motors)
+        if block_size is None:
+            self.mean, self.covariance = darling.properties.moments(
+                self.data, self.motors
+            )
+        else:
+            a, b = self.data.shape[0], self.data.shape[1]
+            dim = len(self.motors)
+            self.mean = np.zeros((a, b, dim), dtype=np.float32)
+            self.covariance = np.zeros((a, b, dim, dim), dtype=np.float32)
+            for r0 in range(0, a, block_size):
+                r1 = min(r0 + block_size, a)
+                self.mean[r0:r1], self.covariance[r0:r1] = darling.properties.moments(
+                    self.data[r0:r1], self.motors
+                )
         return self.mean, self.covariance
 
     def integrate(self):
@@ -353,11 +573,12 @@ class DataSet(object):
         Returns:
             (:obj:`numpy array`): integrated frames, a 2D numpy array.
         """
-        out = np.zeros(
-            (self.data.shape[0], self.data.shape[1]), np.float32
-        )  # avoid casting and copying.
-        integrated_frames = np.sum(self.data, axis=(2, 3), out=out)
-        return integrated_frames
+        # parallel numba reduction: streams each pixel's contiguous (m, n) block
+        # once, with no intermediate cast buffer for the uint16 stack.
+        dum = np.zeros((1,), dtype=np.float32)
+        res = np.zeros((self.data.shape[0], self.data.shape[1], 1), dtype=np.float32)
+        _integrate_frames(self.data, dum, res)
+        return res[..., 0]
 
     def estimate_mask(
         self,
@@ -370,27 +591,112 @@ class DataSet(object):
 
         Args:
             threshold (:obj:`int`):  a summed count value above which the sample is defined.
-            erosion_iterations (:obj:`int`): Number of times to erode the mask using a 2,2 structure.
-            dilation_iterations (:obj:`int`): Number of times to dilate the mask using a 2,2 structure.
+            erosion_iterations (:obj:`int`): Erosion radius in pixels, equivalent to eroding
+                this many times with a centered 3,3 structure.
+            dilation_iterations (:obj:`int`): Dilation radius in pixels, equivalent to dilating
+                this many times with a centered 3,3 structure.
             fill_holes (:obj:`bool`):  Fill enclosed holes in the final mask.
 
         Returns:
             (:obj:`numpy array`): Returns: a binary 2D mask of the sample.
 
         """
+        # erosion and dilation with a centered 2k+1 sided square are thresholds on
+        # the chessboard distance transform, which runs in O(N) independent of the
+        # radii. the background ring added by np.pad reproduces the eroding image
+        # border of binary_erosion.
         mask = self.integrate() > threshold
-        mask = scipy.ndimage.binary_erosion(
-            mask, structure=np.ones((2, 2)), iterations=erosion_iterations
-        )
-        mask = scipy.ndimage.binary_dilation(
-            mask, structure=np.ones((2, 2)), iterations=dilation_iterations
+        distance = scipy.ndimage.distance_transform_cdt(
+            np.pad(mask, 1), metric="chessboard"
         )
+        mask = distance[1:-1, 1:-1] > erosion_iterations
+        if mask.any():
+            distance = scipy.ndimage.distance_transform_cdt(~mask, metric="chessboard")
+            mask = distance <= dilation_iterations
         if fill_holes:
             mask = scipy.ndimage.binary_fill_holes(mask)
         return mask
 
+    def rechunk_source(self, data_name, scan_ids, dest=None, chunk_nbytes=1000000):
+        """Rewrite the reader's diffraction data with ~1 MB chunks aligned to the read pattern.
+
+        HDF5 read throughput is dominated by chunk layout: an ROI read over the detector
+        dimensions should touch as few chunks as possible while each chunk stays around
+        1 MB. This utility copies the data of the reader's h5 file into a new file with
+        such chunking, Bitshuffle compressed, along with the motor datasets. Running
+        load_scan() or compile_layers() against the rewritten file can be several times
+        faster when the source was written with unfavourable chunks.
+
+        Args:
+            data_name (:obj:`str`): path to the data (in the h5) without the prepended scan id.
+            scan_ids (:obj:`str`): scan ids to rewrite, e.g 1.1, 2.1 etc...
+            dest (:obj:`str`): absolute path of the file to write. Defaults to None, in which
+                case the source file name is suffixed with _rechunked.
+            chunk_nbytes (:obj:`int`): target chunk byte size. Defaults to ~1 MB.
+
+        Returns:
+            (:obj:`str`): absolute path to the rewritten h5 file.
+
+        """
+        source = self.reader.abs_path_to_h5_file
+        if dest is None:
+            root, ext = os.path.splitext(source)
+            dest = root + "_rechunked" + ext
+        with h5py.File(source, "r") as h5f_in, h5py.File(dest, "w") as h5f_out:
+            for scan_id in scan_ids:
+                dataset = h5f_in[scan_id][data_name]
+                nframes, det_rows, det_cols = dataset.shape
+                frame_nbytes = det_rows * det_cols * dataset.dtype.itemsize
+                if frame_nbytes <= chunk_nbytes:
+                    chunk_frames = min(nframes, chunk_nbytes // frame_nbytes)
+                    chunks = (chunk_frames, det_rows, det_cols)
+                else:
+                    chunk_rows = max(
+                        1, chunk_nbytes // (det_cols * dataset.dtype.itemsize)
+                    )
+                    chunks = (1, min(det_rows, chunk_rows), det_cols)
+                h5f_out.create_dataset(
+                    scan_id + "/" + data_name,
+                    data=dataset[...],
+                    chunks=chunks,
+                    **hdf5plugin.Bitshuffle(),
+                )
+                for motor_name in self.reader.motor_names:
+                    h5f_out.create_dataset(
+                        scan_id + "/" + motor_name, data=h5f_in[scan_id][motor_name][()]
+                    )
+        return dest
+
+    def _scan_cache_path(self, cache_dir, scan_id):
+        return os.path.join(cache_dir, "scan_" + str(scan_id).replace(".", "_") + ".h5")
+
+    def _write_scan_cache(self, cache_path):
+        """Write the current (preprocessed) scan to a Bitshuffle+LZ4 compressed cache file."""
+        with h5py.File(cache_path, "w") as h5f:
+            h5f.create_dataset(
+                "data", data=self.data, **hdf5plugin.Bitshuffle(cname="lz4")
+            )
+            for k, motor in enumerate(self.motors):
+                h5f.create_dataset("motor_" + str(k), data=motor)
+
+    def _read_scan_cache(self, cache_path):
+        """Read back a scan written by _write_scan_cache."""
+        with h5py.File(cache_path, "r") as h5f:
+            dataset = h5f["data"]
+            data = np.empty(dataset.shape, dtype=dataset.dtype)
+            dataset.read_direct(data)
+            n_motors = len([key for key in h5f.keys() if key.startswith("motor_")])
+            motors = [h5f["motor_" + str(k)][()] for k in range(n_motors)]
+        return data, motors
+
     def compile_layers(
-        self, reader_args, scan_ids, threshold=None, roi=None, verbose=False
+        self,
+        reader_args,
+        scan_ids,
+        threshold=None,
+        roi=None,
+        verbose=False,
+        cache_dir=None,
     ):
         """Sequentially load a series of scans and assemble the 3D moment maps.
 
@@ -399,7 +705,10 @@ class DataSet(object):
 
         NOTE: This function will load data sequentially and compute moments on the fly. While all
         moment maps are stored and concatenated, only one scan (the raw 4d or 5d data) is kept in
-        memory at a time to enhance RAM performance.
+        memory at a time to enhance RAM performance. Reading of the next scan is overlapped with
+        the moment computation of the current scan through a prefetch thread, since h5py releases
+        the GIL during I/O, so the wall time per layer approaches max(read, compute) rather than
+        their sum.
 
         Args:
             data_name (:obj:`str`): path to the data (in the h5) without the prepended scan id
@@ -410,69 +719,104 @@ class DataSet(object):
             roi (:obj:`tuple` or :obj:`int`): row_min row_max and column_min and column_max, defaults to None,
                 in which case all data is loaded
             verbose (:obj:`bool`): Print loading progress or not.
+            cache_dir (:obj:`str`): directory in which to cache the preprocessed (thresholded) scans
+                as Bitshuffle+LZ4 compressed h5 files. On subsequent runs scans found in the cache
+                are loaded from it directly, skipping the raw read and background subtraction, which
+                is faster when disk bandwidth is the bottleneck. NOTE: the cache stores thresholded
+                data; clear the directory when changing the threshold. Defaults to None, in which
+                case no caching takes place.
 
         """
-        mean_3d = []
-        covariance_3d = []
+        mean_3d = covariance_3d = None
         tot_time = 0
-        for i, scan_id in enumerate(scan_ids):
 
-            t1 = time.perf_counter()
-
-            if verbose:
-                print(
-                    "\nREADING SCAN: "
-                    + str(i + 1)
-                    + " out of totally "
-                    + str(len(scan_ids))
-                    + " scans"
-                )
-            self.load_scan(reader_args, scan_id, roi)
-
-            if threshold is not None:
-                if threshold == "auto":
-                    if verbose:
-                        print(
-                            "    Subtracting estimated background for scan id "
-                            + str(scan_id)
-                            + " ..."
-                        )
-                    _threshold = self.estimate_background()
-                    self.threshold(_threshold)
-                else:
+        def _fetch_scan(scan_id):
+            if cache_dir is not None:
+                cache_path = self._scan_cache_path(cache_dir, scan_id)
+                if os.path.exists(cache_path):
+                    data, motors = self._read_scan_cache(cache_path)
+                    return data, motors, True
+            data, motors = self._read_scan(reader_args, scan_id, roi)
+            return data, motors, False
+
+        prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            future = prefetcher.submit(_fetch_scan, scan_ids[0])
+            for i, scan_id in enumerate(scan_ids):
+
+                t1 = time.perf_counter()
+
+                if verbose:
+                    print(
+                        "\nREADING SCAN: "
+                        + str(i + 1)
+                        + " out of totally "
+                        + str(len(scan_ids))
+                        + " scans"
+                    )
+                self.data, self.motors, from_cache = future.result()
+                if i + 1 < len(scan_ids):
+                    future = prefetcher.submit(_fetch_scan, scan_ids[i + 1])
+
+                if threshold is not None and not from_cache:
+                    if threshold == "auto":
+                        if verbose:
+                            print(
+                                "    Subtracting estimated background for scan id "
+                                + str(scan_id)
+                                + " ..."
+                            )
+                        _threshold = self.estimate_background()
+                        self.subtract(_threshold)
+                    else:
+                        if verbose:
+                            print(
+                                "    Subtracting fixed background value="
+                                + str(threshold)
+                                + " for scan id "
+                                + str(scan_id)
+                                + " ..."
+                            )
+                        self.subtract(threshold)
+
+                if cache_dir is not None and not from_cache:
                     if verbose:
-                        print(
-                            "    Subtracting fixed background value="
-                            + str(threshold)
-                            + " for scan id "
-                            + str(scan_id)
-                            + " ..."
-                        )
-                    self.threshold(threshold)
-
-            if verbose:
-                print("    Computing moments for scan id " + str(scan_id) + " ...")
-
-            mean, covariance = self.moments()
-
-            if verbose:
-                print(
-                    "    Concatenating to 3D volume for scan id "
-                    + str(scan_id)
-                    + " ..."
-                )
-            mean_3d.append(mean)
-            covariance_3d.append(covariance)
-
-            t2 = time.perf_counter()
-            tot_time += t2 - t1
-
-            estimated_time_left = str((tot_time / (i + 1)) * (len(scan_ids) - i - 1))
-            if verbose:
-                print("    Estimated time left is : " + estimated_time_left + " s")
-
-        self.mean_3d = np.array(mean_3d)
-        self.covariance_3d = np.array(covariance_3d)
+                        print("    Caching scan id " + str(scan_id) + " ...")
+                    self._write_scan_cache(self._scan_cache_path(cache_dir, scan_id))
+
+                if verbose:
+                    print("    Computing moments for scan id " + str(scan_id) + " ...")
+
+                mean, covariance = self.moments()
+
+                if verbose:
+                    print(
+                        "    Concatenating to 3D volume for scan id "
+                        + str(scan_id)
+                        + " ..."
+                    )
+                if mean_3d is None:
+                    # the per-layer shapes are known after the first scan; preallocate
+                    # the full stacks instead of concatenating a list at the end.
+                    mean_3d = np.empty((len(scan_ids),) + mean.shape, dtype=mean.dtype)
+                    covariance_3d = np.empty(
+                        (len(scan_ids),) + covariance.shape, dtype=covariance.dtype
+                    )
+                mean_3d[i] = mean
+                covariance_3d[i] = covariance
+
+                t2 = time.perf_counter()
+                tot_time += t2 - t1
+
+                if verbose:
+                    estimated_time_left = (tot_time / (i + 1)) * (len(scan_ids) - i - 1)
+                    print("    Estimated time left is : " + str(estimated_time_left) + " s")
+        finally:
+            # always reap the worker, also when a read or moments call raises.
+            prefetcher.shutdown(cancel_futures=True)
+
+        self.mean_3d = mean_3d
+        self.covariance_3d = covariance_3d
 
         if verbose:
             print("\ndone! Total time was : " + str(tot_time) + " s")
@@ -497,31 +841,34 @@ class DataSet(object):
 
         """
 
-        dim = np.array(self.mean_3d.shape)[-1]
-        s, a, b = np.array(self.mean_3d.shape)[0:3]
+        dim = self.mean_3d.shape[-1]
+        s, a, b = self.mean_3d.shape[0:3]
         sg = np.linspace(0, s, s)
         ag = np.linspace(0, a, a)
         bg = np.linspace(0, b, b)
         mesh = np.meshgrid(sg, ag, bg, indexing="ij")
-        points = np.array([x.flatten() for x in mesh])
-        N = points.shape[1]
-        cells = [("vertex", np.array([[i] for i in range(N)]))]
+        points = np.stack([x.ravel() for x in mesh], axis=1)
+        N = points.shape[0]
+        cells = [("vertex", np.arange(N, dtype=np.int64).reshape(-1, 1))]
 
         if len(file.split(".")) == 1:
             filename = file + ".xdmf"
         else:
             filename = file
 
+        # transpose once so the component axes are leading; ravel is then a view
+        # per attribute instead of a full copy per flatten call.
+        mean_t = np.ascontiguousarray(self.mean_3d.transpose(3, 0, 1, 2))
+        covariance_t = np.ascontiguousarray(self.covariance_3d.transpose(3, 4, 0, 1, 2))
+
         point_data = {}
         for i in range(dim):
-            point_data["mean_" + str(i + 1)] = self.mean_3d[:, :, :, i].flatten()
+            point_data["mean_" + str(i + 1)] = mean_t[i].ravel()
             for j in range(i, dim):
-                point_data["cov_" + str(i + 1) + str(j + 1)] = self.covariance_3d[
-                    :, :, :, i, j
-                ].flatten()
+                point_data["cov_" + str(i + 1) + str(j + 1)] = covariance_t[i, j].ravel()
 
         meshio.Mesh(
-            points.T,
+            points,
             cells,
             point_data=point_data,
         ).write(filename)
@@ -15,6 +15,53 @@ import hdf5plugin
 import matplotlib.pyplot as plt
 import numpy as np
 
+try:
+    # optional: direct Blosc2 chunk access, decompressing only the blocks that
+    # intersect an ROI instead of running every chunk through the HDF5 filter
+    # pipeline.
+    import b2h5py
+except ImportError:
+    b2h5py = None
+
+
+def _read_roi_chunk_aligned(dataset, r1, r2, c1, c2):
+    """Read a detector roi from an unfiltered chunked dataset via whole-chunk reads.
+
+    HDF5's selection engine assembles hyperslab reads element by element, which for
+    roi reads can be much slower than fetching whole chunks and slicing them in
+    NumPy. This reads every chunk intersecting (:, r1:r2, c1:c2) directly with
+    Dataset.id.read_direct_chunk and copies the intersecting subregions into a
+    preallocated output.
+
+    NOTE: read_direct_chunk returns the raw stored bytes, so this is only valid for
+    datasets without a filter pipeline.
+
+    Args:
+        dataset (:obj:`h5py.Dataset`): chunked, unfiltered dataset of shape=(nframes, rows, columns).
+        r1, r2, c1, c2 (:obj:`int`): row and column bounds of the roi.
+
+    Returns:
+        (:obj:`numpy array`): the roi data of shape=(nframes, r2 - r1, c2 - c1).
+
+    """
+    nframes, nrows, ncols = dataset.shape
+    cf, cy, cx = dataset.chunks
+    out = np.empty((nframes, r2 - r1, c2 - c1), dtype=dataset.dtype)
+    # read_direct_chunk wants a flat byte buffer; view it with the chunk shape.
+    chunk_bytes = np.empty(cf * cy * cx * dataset.dtype.itemsize, dtype=np.uint8)
+    chunk = chunk_bytes.view(dataset.dtype).reshape(dataset.chunks)
+    for f0 in range(0, nframes, cf):
+        f1 = min(f0 + cf, nframes)
+        for y0 in range(r1 - r1 % cy, r2, cy):
+            for x0 in range(c1 - c1 % cx, c2, cx):
+                dataset.id.read_direct_chunk((f0, y0, x0), out=chunk_bytes)
+                y_lo, y_hi = max(y0, r1), min(y0 + cy, r2, nrows)
+                x_lo, x_hi = max(x0, c1), min(x0 + cx, c2, ncols)
+                out[f0:f1, y_lo - r1 : y_hi - r1, x_lo - c1 : x_hi - c1] = chunk[
+                    : f1 - f0, y_lo - y0 : y_hi - y0, x_lo - x0 : x_hi - x0
+                ]
+    return out
+
 
 class Reader(object):
     """Parent class for readers.
@@ -77,11 +124,20 @@ class MosaScan(Reader):
         self.abs_path_to_h5_file = abs_path_to_h5_file
         self.motor_names = motor_names
         self.motor_precision = motor_precision
+        self._motor_cache = {}
 
         assert len(self.motor_precision) == len(
             self.motor_names
         ), "The motor_precision lengths need to match the motor_names length"
 
+    def invalidate_motor_cache(self):
+        """Drop the cached motor coordinate arrays.
+
+        Call this if the motor datasets of the h5 file were rewritten after the
+        reader already loaded a scan.
+        """
+        self._motor_cache = {}
+
     def __call__(self, data_name, scan_id, roi=None):
         """Load a scan
 
@@ -99,28 +155,79 @@ class MosaScan(Reader):
             data, motors : data of shape (a,b,m,n) and motors tuple of len=m and len=n
 
         """
-        with h5py.File(self.abs_path_to_h5_file, "r") as h5f:
-
-            # Read in motors
-            raw_motors = [h5f[scan_id][mn] for mn in self.motor_names]
-            motors = [
-                np.unique(np.round(m, p)).astype(np.float32)
-                for p, m in zip(self.motor_precision, raw_motors)
-            ]
+        # a large chunk cache with a prime slot count avoids re-decompressing
+        # chunks shared by neighbouring frames; the h5py defaults (1 MiB, 521
+        # slots) thrash as soon as a single detector chunk exceeds the cache.
+        with h5py.File(
+            self.abs_path_to_h5_file,
+            "r",
+            rdcc_nbytes=256 * 1024 * 1024,
+            rdcc_nslots=1000003,
+            rdcc_w0=0.75,
+        ) as h5f:
+
+            # Read in motors. [()] pulls each motor array in a single HDF5 call;
+            # rounding to the trusted precision then reduces to an integer-bucket
+            # unique, which sidesteps float sorting subtleties. the per-scan
+            # result is cached since layered experiments revisit the same motor
+            # grids; use invalidate_motor_cache() if the file is rewritten.
+            cache_key = (
+                scan_id,
+                tuple(self.motor_names),
+                tuple(self.motor_precision),
+            )
+            if cache_key in self._motor_cache:
+                motors = list(self._motor_cache[cache_key])
+            else:
+                motors = []
+                for p, mn in zip(self.motor_precision, self.motor_names):
+                    raw = h5f[scan_id][mn][()]
+                    scale = 10.0**p
+                    keys = np.unique(np.rint(raw * scale).astype(np.int64))
+                    motors.append((keys / scale).astype(np.float32))
+                self._motor_cache[cache_key] = list(motors)
             voxel_distribution_shape = [len(m) for m in motors]
 
-            # read in data and reshape
+            # read in data and reshape. read_direct fills a preallocated buffer
+            # avoiding the intermediate array assembly of fancy __getitem__ reads.
+            dataset = h5f[scan_id][data_name]
             if roi:
                 r1, r2, c1, c2 = roi
-                data = h5f[scan_id][data_name][:, r1:r2, c1:c2]
+                data = None
+                if b2h5py is not None:
+                    try:
+                        # decompresses only the Blosc2 blocks intersecting the roi.
+                        data = b2h5py.B2Dataset(dataset)[:, r1:r2, c1:c2]
+                    except Exception:
+                        # not a blosc2 compressed dataset; fall back to hdf5 reads.
+                        data = None
+                if (
+                    data is None
+                    and dataset.chunks is not None
+                    and dataset.id.get_create_plist().get_nfilters() == 0
+                ):
+                    # uncompressed chunked data: whole-chunk reads sliced in numpy
+                    # beat the hdf5 hyperslab selection engine.
+                    data = _read_roi_chunk_aligned(dataset, r1, r2, c1, c2)
+                if data is None:
+                    data = np.empty(
+                        (dataset.shape[0], r2 - r1, c2 - c1), dtype=dataset.dtype
+                    )
+                    dataset.read_direct(data, source_sel=np.s_[:, r1:r2, c1:c2])
             else:
-                data = h5f[scan_id][data_name][:, :, :]
+                data = np.empty(dataset.shape, dtype=dataset.dtype)
+                dataset.read_direct(data)
 
             data = data.reshape(
                 (*voxel_distribution_shape, data.shape[-2], data.shape[-1])
             )
-            data = data.swapaxes(0, 2)
-            data = data.swapaxes(1, -1)
+            # single transpose + contiguous copy instead of chained swapaxes views:
+            # downstream kernels (moments, integrate) then stream the motor
+            # dimensions contiguously rather than striding across all axes.
+            perm = list(range(data.ndim))
+            perm[0], perm[2] = perm[2], perm[0]
+            perm[1], perm[-1] = perm[-1], perm[1]
+            data = np.ascontiguousarray(data.transpose(perm))
 
         return data, motors
 
@@ -195,7 +302,13 @@ class EnergyScan(Reader):
         abs_path_to_h5_file = self._get_layer_path(scan_id)
         dname, mnames = self._pad_h5_paths(data_name, self.motor_names)
 
-        with h5py.File(abs_path_to_h5_file, "r") as h5f:
+        with h5py.File(
+            abs_path_to_h5_file,
+            "r",
+            rdcc_nbytes=256 * 1024 * 1024,
+            rdcc_nslots=1000003,
+            rdcc_w0=0.75,
+        ) as h5f:
             key0 = list(h5f.keys())[0]
 
             chi = h5f[key0 + mnames[1]][:].astype(np.float32)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import unittest
 
 import matplotlib.pyplot as plt
@@ -93,6 +94,11 @@ class TestDataSet(unittest.TestCase):
             self.assertEqual(covariance.shape[2], 2)
             self.assertEqual(covariance.shape[3], 2)
 
+            # blocked computation must match the single-pass result.
+            mean_blocked, covariance_blocked = dset.moments(block_size=7)
+            np.testing.assert_allclose(mean_blocked, mean)
+            np.testing.assert_allclose(covariance_blocked, covariance)
+
             if self.debug:
                 dset.plot.mean()
 
@@ -130,6 +136,27 @@ class TestDataSet(unittest.TestCase):
                 plt.tight_layout()
                 plt.show()
     
+    def test_rechunk_source(self):
+        dset = darling.DataSet(self.reader_1)
+        dset.load_scan(self.data_name_1, scan_id="1.1", roi=None)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dest = os.path.join(tmp_dir, "rechunked.h5")
+            path = dset.rechunk_source(
+                self.data_name_1, scan_ids=["1.1", "2.1"], dest=dest
+            )
+            self.assertEqual(path, dest)
+
+            # the rewritten file must read back identically through the reader.
+            reader = darling.reader.MosaScan(
+                dest,
+                ["instrument/diffrz/data", "instrument/chi/value"],
+                motor_precision=[2, 2],
+            )
+            dset_rechunked = darling.DataSet(reader)
+            dset_rechunked.load_scan(self.data_name_1, scan_id="1.1", roi=None)
+            np.testing.assert_array_equal(dset_rechunked.data, dset.data)
+
     def test_compile_layers(self):
 
         # test that the mosa reader will stack layers
@@ -152,6 +179,12 @@ class TestDataSet(unittest.TestCase):
         self.assertEqual(cov_3d.shape[0], 2)
         self.assertEqual(len(cov_3d.shape), 5)
 
+        # the background subtraction path must also run.
+        mean_3d, cov_3d = dset_mosa.compile_layers(
+            data_name, scan_ids=["1.1", "2.1"], threshold=50, verbose=False
+        )
+        self.assertEqual(mean_3d.shape[0], 2)
+
         # test that the energy reader can stack layers.
         path_to_data, _, _ = darling.assets.energy_scan()
         data_name = "instrument/pco_ff/data"
@@ -170,6 +203,29 @@ class TestDataSet(unittest.TestCase):
         self.assertEqual(cov_3d.shape[0], 2)
         self.assertEqual(len(cov_3d.shape), 5)
 
+    def test_compile_layers_cache(self):
+        path_to_data, _, _ = darling.assets.mosaicity_scan()
+        reader = darling.reader.MosaScan(
+            path_to_data,
+            ["instrument/chi/value", "instrument/diffrz/data"],
+            motor_precision=[3, 3],
+        )
+
+        data_name = "instrument/pco_ff/image"
+        dset_mosa = darling.DataSet(reader)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            mean_3d, cov_3d = dset_mosa.compile_layers(
+                data_name, scan_ids=["1.1", "2.1"], cache_dir=cache_dir
+            )
+
+            # second run reads from the cache and must reproduce the maps.
+            mean_3d_cached, cov_3d_cached = dset_mosa.compile_layers(
+                data_name, scan_ids=["1.1", "2.1"], cache_dir=cache_dir
+            )
+            np.testing.assert_allclose(mean_3d_cached, mean_3d)
+            np.testing.assert_allclose(cov_3d_cached, cov_3d)
+
     def test_as_paraview(self):
         path_to_data, _, _ = darling.assets.mosaicity_scan()
         reader = darling.reader.MosaScan(
@@ -1,6 +1,8 @@
 import os
+import tempfile
 import unittest
 
+import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -92,6 +94,41 @@ class TestMosaScan(unittest.TestCase):
         self.assertNotEqual( np.max(np.abs(residual)), 0)
 
 
+    def test_motor_cache(self):
+        # repeated reads of the same scan reuse the cached motor arrays and
+        # invalidation forces a fresh read with identical values.
+        reader = darling.reader.MosaScan(
+            self.path_to_data,
+            self.motor_names,
+            motor_precision=[2, 2],
+        )
+
+        _, motors = reader(data_name=self.data_name, scan_id="1.1")
+        _, motors_cached = reader(data_name=self.data_name, scan_id="1.1")
+        self.assertTrue(motors_cached[0] is motors[0])
+
+        reader.invalidate_motor_cache()
+        _, motors_fresh = reader(data_name=self.data_name, scan_id="1.1")
+        self.assertFalse(motors_fresh[0] is motors[0])
+        np.testing.assert_array_equal(motors_fresh[0], motors[0])
+        np.testing.assert_array_equal(motors_fresh[1], motors[1])
+
+    def test_chunk_aligned_roi_read(self):
+        # the whole-chunk roi read path must agree with plain hyperslab slicing,
+        # including rois that are not aligned to the chunk grid.
+        data = np.random.randint(0, 65535, size=(12, 40, 60), dtype=np.uint16)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "chunked.h5")
+            with h5py.File(path, "w") as h5f:
+                h5f.create_dataset("data", data=data, chunks=(5, 16, 32))
+            with h5py.File(path, "r") as h5f:
+                for roi in [(0, 40, 0, 60), (3, 29, 7, 41), (16, 32, 32, 60)]:
+                    r1, r2, c1, c2 = roi
+                    roi_data = darling.reader._read_roi_chunk_aligned(
+                        h5f["data"], r1, r2, c1, c2
+                    )
+                    np.testing.assert_array_equal(roi_data, data[:, r1:r2, c1:c2])
+
     def check_data(self, data, motors):
         self.assertTrue(data.dtype == np.uint16)
         self.assertTrue(len(data.shape) == 4)